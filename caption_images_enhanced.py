@@ -1,47 +1,145 @@
 import ollama
-import json
+import httpx
+import orjson
 import os
-import csv
+import asyncio
+import io
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from PIL import Image
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
 import global_context_builder as gcb
 
 # Define paths
 HOME = Path.home()
 CONTEXT_FOLDER_PATH = f'{HOME}/context'
 
+# Number of completions the Ollama server batches per loaded model. Only the
+# server reads it, at startup (export it before `ollama serve`); we read the
+# same variable to keep exactly this many requests in flight so every
+# parallel slot stays busy.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "8"))
+
+# Caption files are handed to one writer thread so requests never wait on disk
+_WRITE_Q = queue.Queue()
+
+def _caption_writer():
+    while True:
+        file_path, payload = _WRITE_Q.get()
+        try:
+            with open(file_path, 'wb') as f:
+                f.write(payload)
+        except OSError as e:
+            print(f"❌ Could not write {file_path}: {e}")
+        finally:
+            _WRITE_Q.task_done()
+
+threading.Thread(target=_caption_writer, name="caption-writer", daemon=True).start()
+
+def flush_captions():
+    """Block until every queued caption has been written."""
+    _WRITE_Q.join()
+
+def make_client():
+    """One async client per run: its httpx pool keeps a warm connection per in-flight request."""
+    return ollama.AsyncClient(
+        host=os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434"),
+        limits=httpx.Limits(max_keepalive_connections=OLLAMA_NUM_PARALLEL),
+    )
+
+MODEL = "gemma3:4b"
+# Ollama only reuses a cached prompt prefix when the model stays loaded and
+# num_ctx matches, so every call of a run shares the same settings.
+KEEP_ALIVE = "1h"
+# Gemma 3 encodes each image as 256 soft tokens; the local context is a short
+# header plus a few seconds of transcript.
+IMAGE_TOKENS = 256
+LOCAL_CONTEXT_TOKENS = 192
+NUM_PREDICT = 512
+
+def build_chat_options(system_prompt):
+    """Chat options for a run, with num_ctx sized to the prompt instead of a flat 4096.
+
+    Every parallel slot reserves a num_ctx-sized KV cache, so a smaller window
+    leaves VRAM for more OLLAMA_NUM_PARALLEL slots.
+    """
+    # ~3 characters per token errs on the safe side of the usual ~4
+    needed = len(system_prompt) // 3 + IMAGE_TOKENS + LOCAL_CONTEXT_TOKENS + NUM_PREDICT
+    num_ctx = 1024
+    while num_ctx < needed:
+        num_ctx *= 2
+    return {"temperature": 0.1, "num_ctx": num_ctx, "num_predict": NUM_PREDICT}
+
 # --- NEW: Load transcript once into memory ---
 def load_transcript_cache(video_file):
-    """Loads the entire transcript into a list of dicts for fast access."""
+    """Loads the transcript as parallel (starts, words) NumPy arrays sorted by start time."""
     csv_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/audio/transcript_16k_word_ts.csv'
     if not os.path.exists(csv_path):
         return None
     
     try:
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            return list(csv.DictReader(f))
+        # keep_default_na: a transcribed word like "null" must stay a word
+        df = pd.read_csv(csv_path, usecols=['start_sec', 'word'],
+                         dtype={'word': str}, keep_default_na=False)
+        df['start_sec'] = pd.to_numeric(df['start_sec'], errors='coerce')
+        df = df.dropna(subset=['start_sec']).sort_values('start_sec', kind='stable')
+        return df['start_sec'].to_numpy(), df['word'].to_numpy()
     except Exception as e:
         print(f"Error loading transcript: {e}")
         return None
 
 def get_transcript_from_cache(transcript_data, timestamp, window=3.0):
-    """Fast lookup from memory instead of disk."""
-    if not transcript_data:
+    """Words starting within `window` seconds of `timestamp`, via binary search."""
+    if not transcript_data or not len(transcript_data[0]):
         return "no transcription available"
 
-    words = []
-    # Optimization: This is still linear search but generally fast enough for memory.
-    # For very long videos, you could optimize further with bisect, but this is fine for now.
-    for r in transcript_data:
-        try:
-            start = float(r['start_sec'])
-            if abs(start - timestamp) <= window:
-                words.append(r['word'])
-        except ValueError:
-            continue
+    starts, words = transcript_data
+    lo = np.searchsorted(starts, timestamp - window, side='left')
+    hi = np.searchsorted(starts, timestamp + window, side='right')
     
-    return " ".join(words) if words else "silence"
+    return " ".join(words[lo:hi].tolist()) if hi > lo else "silence"
+
+# Invariant prompt text, rendered once instead of per image. It goes in the
+# system message, ahead of the per-frame image and transcript, so the server's
+# prefix cache covers all of it.
+_PROMPT_HEADER = """You are analyzing a video frame with accompanying audio context.
+### GLOBAL VIDEO CONTEXT (Use for identification)
+"""
+
+_PROMPT_SUFFIX = """
+TASK: Provide a cohesive description of this moment.
+INSTRUCTIONS:
+1. VISUAL: Describe the image in detail (scenery, objects, atmosphere).
+2. AUDIO: If the transcript shows someone speaking, identify them using Global Context.
+3. SYNTHESIS: If the speaker is NOT in the frame, describe them as "speaking off-camera" or "narrating over the scene".
+4. IDENTITY: Do not just say "a man"; use names from Global Context if they match the transcript or appearance.
+5. DONT's : do not requote the trasncript that is being sent to you.
+
+Return ONLY this JSON:
+{
+  "description": "A paragraph describing the visual scene AND how the audio/transcript relates to it ",
+  "entities": ["names of visible people", "identified off-camera speakers", "key objects"],
+  "actions": ["visual actions", "speech or narration"]
+}
+"""
+
+def build_system_prompt(global_context_text):
+    """Everything except the per-frame fields; constant for a whole video."""
+    return f"{_PROMPT_HEADER}{global_context_text}\n{_PROMPT_SUFFIX}"
+
+async def warm_prompt_cache(client, system_prompt, options):
+    """Load the model and prefill the shared system prompt once before the workers start."""
+    try:
+        await client.chat(
+            model=MODEL,
+            messages=[{"role": "system", "content": system_prompt}],
+            options={**options, "num_predict": 1},
+            keep_alive=KEEP_ALIVE
+        )
+    except Exception as e:
+        print(f"⚠️ Prompt cache warm-up failed: {e}")
 
 def format_global_context_for_prompt(global_context):
     prompt = "### GLOBAL VIDEO CONTEXT ###\n"
@@ -58,62 +156,50 @@ def format_global_context_for_prompt(global_context):
     return prompt
 
 # --- CHANGED: Accept transcript_cache as an argument ---
-def process_single_image(image_file, video_file, caption_path, global_context_text, transcript_cache):
-    images_folder_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images'
-    image_path = os.path.abspath(os.path.join(images_folder_path, image_file))
-    
-    if not os.path.exists(image_path):
-        return f"❌ Missing: {image_file}"
-    
+async def process_single_image(client, image_file, image_path, caption_path, system_prompt, options, transcript_cache):
     try:
         timestamp = float(Path(image_file).stem)
         # Use the memory cache function
         transcript = get_transcript_from_cache(transcript_cache, timestamp)
         
-        prompt = f"""You are analyzing a video frame with accompanying audio context.
-### GLOBAL VIDEO CONTEXT (Use for identification)
-{global_context_text}
-
-### LOCAL CONTEXT
+        prompt = f"""### LOCAL CONTEXT
 Timestamp: {timestamp:.2f}s
 Audio/Transcript: "{transcript}"
-
-TASK: Provide a cohesive description of this moment.
-INSTRUCTIONS:
-1. VISUAL: Describe the image in detail (scenery, objects, atmosphere).
-2. AUDIO: If the transcript shows someone speaking, identify them using Global Context.
-3. SYNTHESIS: If the speaker is NOT in the frame, describe them as "speaking off-camera" or "narrating over the scene".
-4. IDENTITY: Do not just say "a man"; use names from Global Context if they match the transcript or appearance.
-5. DONT's : do not requote the trasncript that is being sent to you.
-
-Return ONLY this JSON:
-{{
-  "description": "A paragraph describing the visual scene AND how the audio/transcript relates to it ",
-  "entities": ["names of visible people", "identified off-camera speakers", "key objects"],
-  "actions": ["visual actions", "speech or narration"]
-}}
 """
         
-        with open(image_path, 'rb') as f:
-            image_bytes = f.read()
-
-        # Instantiate a client explicitly (good practice for threading)
-        client = ollama.Client()
+        # Read (and resize) off the event loop so other requests keep streaming meanwhile
+        image_bytes = await asyncio.to_thread(load_model_image, image_path)
         
-        resp = client.chat(
-            model="gemma3:4b",
-            messages=[{
-                "role": "user",
-                "content": prompt,
-                "images": [image_bytes]
-            }],
+        # Stream so the connection is read as tokens arrive instead of idling
+        # until the whole JSON has been generated
+        stream = await client.chat(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": prompt,
+                    "images": [image_bytes]
+                }
+            ],
             format="json",
-            options={"temperature": 0.1, "num_ctx": 4096}
+            options=options,
+            keep_alive=KEEP_ALIVE,
+            stream=True
         )
-
-        content = resp["message"]["content"]
+        parts = []
+        async for chunk in stream:
+            parts.append(chunk["message"]["content"])
+        content = "".join(parts)
         # Parse JSON string to dictionary before modifying
-        content_dict = json.loads(content) if isinstance(content, str) else content
+        try:
+            content_dict = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            content_dict = None
+        if not is_valid_caption(content_dict):
+            # save_caption keeps the raw text and flags it
+            save_caption(image_file, caption_path, content)
+            return f"⚠️ {image_file}: response does not match the caption schema"
         content_dict["transcript"] = transcript
         save_caption(image_file, caption_path, content_dict)
         return f"✅ {image_file}"
@@ -125,79 +211,245 @@ Return ONLY this JSON:
             "actions": [],
             "error": True
         }
-        save_caption(image_file, caption_path, json.dumps(error_entry))
+        save_caption(image_file, caption_path, error_entry)
         return f"❌ {image_file}: {str(e)}"
 
+# Gemma 3's vision encoder sees 896x896; larger frames only cost upload and resize time
+MAX_IMAGE_EDGE = 896
+
+def load_model_image(image_path):
+    """JPEG bytes for the model, downscaled to MAX_IMAGE_EDGE and cached next to the images folder."""
+    st = os.stat(image_path)
+    source = Path(image_path)
+    cache_dir = source.parent.with_name('images_resized')
+    # Size and mtime in the name invalidate the cache when a frame is re-extracted
+    cached = cache_dir / f'{source.stem}_{st.st_size}_{st.st_mtime_ns}.jpg'
+    try:
+        return cached.read_bytes()
+    except FileNotFoundError:
+        pass
+
+    with Image.open(source) as img:
+        if max(img.size) <= MAX_IMAGE_EDGE:
+            return source.read_bytes()
+        # libjpeg can decode straight at 1/2, 1/4 or 1/8 scale; draft picks the
+        # smallest that still covers MAX_IMAGE_EDGE, so fewer pixels get decoded
+        img.draft('RGB', (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+        img = img.convert('RGB')
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=85, optimize=True)
+
+    data = buf.getvalue()
+    cache_dir.mkdir(exist_ok=True)
+    cached.write_bytes(data)
+    return data
+
+IMAGE_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg'})
+
+# Frames whose 64-bit dHash differs from the previous distinct frame by at
+# most this many bits are treated as the same shot
+DEDUP_MAX_DISTANCE = 4
+
+def _dhash(image_path):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a 9x8 grayscale thumbnail."""
+    with Image.open(image_path) as img:
+        # a 1/8-scale grayscale JPEG decode is plenty for a 9x8 thumbnail
+        img.draft('L', (9, 8))
+        pixels = img.convert('L').resize((9, 8), Image.Resampling.BOX).tobytes()
+    bits = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            bits = (bits << 1) | (pixels[col] > pixels[col + 1])
+    return bits
+
+def find_duplicate_frames(images, max_distance=DEDUP_MAX_DISTANCE):
+    """Map each near-duplicate frame to the earlier frame of the same shot it repeats.
+
+    `images` is the timestamp-sorted list of (name, path); only consecutive
+    frames are compared, so a shot that reappears later is captioned again.
+    """
+    duplicates = {}
+    ref_name, ref_hash = None, None
+    for name, path in images:
+        try:
+            frame_hash = _dhash(path)
+        except OSError:
+            ref_name = None
+            continue
+        if ref_name is not None and (frame_hash ^ ref_hash).bit_count() <= max_distance:
+            duplicates[name] = ref_name
+        else:
+            ref_name, ref_hash = name, frame_hash
+    return duplicates
+
+def save_duplicate_captions(duplicates, caption_path, transcript_cache):
+    """Copy each representative's caption to its duplicates, with their own transcript.
+
+    Returns how many were copied and the duplicates whose representative has
+    no usable caption, which must be captioned themselves.
+    """
+    saved = 0
+    uncaptioned = set()
+    for image_file, ref in duplicates.items():
+        try:
+            with open(f'{caption_path}/{ref}.json', 'rb') as f:
+                caption = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            uncaptioned.add(image_file)
+            continue
+        if type(caption) is not dict or "error" in caption:
+            uncaptioned.add(image_file)
+            continue
+        timestamp = float(Path(image_file).stem)
+        caption["transcript"] = get_transcript_from_cache(transcript_cache, timestamp)
+        caption["ref"] = ref
+        save_caption(image_file, caption_path, caption)
+        saved += 1
+    return saved, uncaptioned
+
+def _is_finished_caption(path):
+    """A caption file counts as done unless it is empty, unreadable or an error entry."""
+    try:
+        with open(path, 'rb') as f:
+            data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return False
+    return type(data) is dict and bool(data) and "error" not in data
+
+def list_captioned(caption_path):
+    """Names of frames that already have a finished caption, so failed frames are retried on resume."""
+    if not os.path.isdir(caption_path):
+        return set()
+    with os.scandir(caption_path) as it:
+        # Anything no larger than "{}" is empty; skip it without opening
+        return {e.name[:-len('.json')] for e in it
+                if e.name.endswith('.json') and e.stat().st_size > 2 and _is_finished_caption(e.path)}
+
+def is_valid_caption(data):
+    """Shape check for the caption JSON we ask for: a few type lookups, never raises."""
+    return (type(data) is dict
+            and type(data.get("description")) is str
+            and type(data.get("entities")) is list
+            and type(data.get("actions")) is list)
+
 def save_caption(image_file, caption_path, caption):
     os.makedirs(caption_path, exist_ok=True)
     file_path = f'{caption_path}/{image_file}.json'
     try:
-        data = json.loads(caption) if isinstance(caption, str) else caption
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
-    except:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump({"raw": str(caption), "error": "json_parse_error"}, f, indent=4)
-
-def process_video_images(video_file, caption_path, global_context, max_workers=2):
+        data = orjson.loads(caption) if isinstance(caption, str) else caption
+    except orjson.JSONDecodeError:
+        data = None
+    if is_valid_caption(data):
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        payload = orjson.dumps({"raw": str(caption), "error": "json_parse_error"}, option=orjson.OPT_INDENT_2)
+    # orjson already produces UTF-8 bytes; the writer thread does the I/O
+    _WRITE_Q.put((file_path, payload))
+
+async def process_video_images(video_file, caption_path, global_context, max_workers=OLLAMA_NUM_PARALLEL):
     images_folder_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images'
     
     if not os.path.exists(images_folder_path):
         print(f"Images folder not found: {images_folder_path}")
         return
 
-    images = [f for f in os.listdir(images_folder_path) 
-              if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    images.sort(key=lambda x: float(Path(x).stem))
+    # One scandir pass yields names and absolute paths; no per-frame stat later
+    with os.scandir(images_folder_path) as it:
+        images = [(e.name, e.path) for e in it
+                  if e.name.rpartition('.')[2].lower() in IMAGE_EXTENSIONS and e.is_file()]
+    images.sort(key=lambda x: float(Path(x[0]).stem))
 
     if not images:
         print("No images to process.")
         return
 
+    # Resume interrupted runs: a VLM call costs seconds, a directory scan does not
+    pending = images
+    captioned = list_captioned(caption_path)
+    if captioned:
+        pending = [img for img in images if img[0] not in captioned]
+        print(f"⏭️  Skipping {len(images) - len(pending)} already-captioned images")
+        if not pending:
+            print("All images already captioned.")
+            return
+
+    # Static shots produce runs of near-identical frames; caption one per run.
+    # Only pending frames are hashed, plus the captioned frame just before each
+    # run of them, which stands in as that run's representative
+    pending_names = {name for name, _ in pending}
+    scope = []
+    for i, img in enumerate(images):
+        if img[0] in pending_names:
+            if i and images[i - 1][0] not in pending_names:
+                scope.append(images[i - 1])
+            scope.append(img)
+    duplicates = await asyncio.to_thread(find_duplicate_frames, scope)
+    pending_duplicates = {name: duplicates[name] for name, _ in pending if name in duplicates}
+    images = [img for img in pending if img[0] not in pending_duplicates]
+
     global_context_text = format_global_context_for_prompt(global_context)
-    
+    system_prompt = build_system_prompt(global_context_text)
+    options = build_chat_options(system_prompt)
+    print(f"Context window: {options['num_ctx']} tokens")
+
     # --- NEW: Load transcript ONCE before the loop ---
     print("Loading transcript into memory...")
     transcript_cache = load_transcript_cache(video_file)
 
-    print(f"\n🚀 Processing {len(images)} images with {max_workers} workers...")
+    print(f"\n🚀 Processing {len(images)} images with {max_workers} requests in flight...")
     
-    completed = 0
-    total = len(images)
-    lock = Lock()
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Pass the transcript_cache to the workers
-        futures = {
-            executor.submit(process_single_image, img, video_file, caption_path, global_context_text, transcript_cache): img 
-            for img in images
-        }
-        
-        for future in as_completed(futures):
-            res = future.result()
-            with lock:
-                completed += 1
-                print(f"[{completed}/{total}] {res}")
+    # Bounds in-flight requests independently of any thread count
+    semaphore = asyncio.Semaphore(max_workers)
+
+    # One client for the whole run, closed afterwards so its pooled
+    # connections don't outlive this event loop
+    async with make_client() as client:
+        await warm_prompt_cache(client, system_prompt, options)
+
+        async def bounded(image_file, image_path):
+            async with semaphore:
+                return await process_single_image(client, image_file, image_path, caption_path, system_prompt, options, transcript_cache)
+
+        async def caption_all(batch):
+            tasks = [asyncio.create_task(bounded(name, path)) for name, path in batch]
+            for completed, task in enumerate(asyncio.as_completed(tasks), 1):
+                print(f"[{completed}/{len(batch)}] {await task}")
+            await asyncio.to_thread(flush_captions)
+
+        await caption_all(images)
+
+        if pending_duplicates:
+            saved, uncaptioned = save_duplicate_captions(pending_duplicates, caption_path, transcript_cache)
+            print(f"🪞 {saved}/{len(pending_duplicates)} near-duplicate frames reuse an earlier caption")
+            await asyncio.to_thread(flush_captions)
+            # A representative that failed leaves its duplicates to be captioned directly
+            if uncaptioned:
+                print(f"🔁 Captioning {len(uncaptioned)} frames whose representative has no caption")
+                await caption_all([img for img in pending if img[0] in uncaptioned])
 
-def execute(video_file, max_workers=4):
+def execute(video_file, max_workers=OLLAMA_NUM_PARALLEL):
     global_context = gcb.load_global_context(video_file)
     if not global_context:
         print("⚠️ Building missing global context...")
         global_context = gcb.execute(video_file)
     
     caption_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images_caption'
-    process_video_images(video_file, caption_path, global_context, max_workers)
+    asyncio.run(process_video_images(video_file, caption_path, global_context, max_workers))
 
     # global_context_text = format_global_context_for_prompt(global_context)
+    # system_prompt = build_system_prompt(global_context_text)
+    # options = build_chat_options(system_prompt)
     # transcript_cache = load_transcript_cache(video_file)
-    # process_single_image("16.27.jpg", video_file, caption_path, global_context_text, transcript_cache)
+    # image_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images/16.27.jpg'
+    # asyncio.run(process_single_image(make_client(), "16.27.jpg", image_path, caption_path, system_prompt, options, transcript_cache))
     
     return caption_path
 
 if __name__ == "__main__":
     import sys
-    # Default to 4 workers if not specified
-    max_workers_arg = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    # Default to one worker per Ollama parallel slot if not specified
+    max_workers_arg = int(sys.argv[1]) if len(sys.argv) > 1 else OLLAMA_NUM_PARALLEL
     
     # HARDCODED FOR DEMO (You can change this back)
     target_video = "demo.mp4" 
@@ -1,8 +1,15 @@
 import subprocess
+import asyncio
 import json
+import math
 import os
+import orjson
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
-import cv2
 from static_ffmpeg import run
 ffmpeg, ffprobe = run.get_or_fetch_platform_executables_else_raise()
 print(f"FFprobe path: {ffprobe}")
@@ -17,15 +24,9 @@ print("Context folder path:", context_folder_path)
 
 # Verify the file exists
 def verify_video_path(video_path):
-    if not os.path.exists(context_folder_path):
-        os.makedirs(context_folder_path)
-    else:
-        print("Context folder already exists")
-
-    # create a folder with the video's name
+    # create a folder with the video's name (and the context folder above it)
     video_folder_path = f'{context_folder_path}/{video_file}'
-    if not os.path.exists(video_folder_path):
-        os.makedirs(video_folder_path)  
+    os.makedirs(video_folder_path, exist_ok=True)
 
     if not os.path.exists(video_path):
         raise FileNotFoundError(f"Video file not found: {video_path}")
@@ -33,63 +34,141 @@ def verify_video_path(video_path):
     print(f"Video file: {video_path}")
     print(f"File size: {os.path.getsize(video_path):,} bytes")
 
-# this will give you the keyframes and their data
-def extract_keyframe_offsets(video_path, video_file):
-    """
-    Extract keyframe information including byte offsets from a video file.
-    
-    Returns:
-        list: List of dictionaries containing keyframe metadata
-    """
-
-    # 
-    
-    # Use ffprobe to get packet information
-    cmd = [
+def _probe_cmd(video_path):
+    # Use ffprobe to get packet information. Every packet still has to be
+    # listed to keep frame_number, but the compact output is one short line
+    # per packet and only keyframe lines get parsed
+    return [
         ffprobe,
         '-v', 'error',
         '-select_streams', 'v:0',  # Select first video stream
-        '-show_entries', 'packet=pts_time,pos,flags,size',  # Get timestamp, position, flags, and size
-        '-of', 'json',  # Output as JSON
+        '-show_entries', 'packet=pts_time,pos,flags,size:format=duration',  # Get timestamp, position, flags, size, and the duration
+        '-of', 'compact',  # One "section|key=value|..." line per entry
         video_path
     ]
+
+def _parse_probe_lines(lines):
+    """Turn ffprobe's compact packet listing (bytes lines) into (keyframes, duration)."""
+    keyframes = []
+    frame_num = 0
+    duration = 0.0
     
-    try:
-        result = subprocess.run(cmd, capture_output = True, text = True, check = True)
-        if result.stderr:
-            print("ffprobe stderr:", result.stderr)
-        
-        data = json.loads(result.stdout)
-        
-        keyframes = []
-        frame_num = 0
-        
-        for packet in data.get('packets', []):
+    # Lines stay bytes: only the keyframe lines are ever decoded
+    for line in lines:
+        if line.startswith(b'packet|'):
             # Check if this is a keyframe (I-frame)
             # The 'K' flag indicates a keyframe
-            if 'K' in packet.get('flags', ''):
+            if b'|flags=K' in line:
+                packet = dict(field.split('=', 1) for field in line.decode().rstrip('\n').split('|')[1:])
                 keyframe_info = {
                     'frame_number': frame_num,
-                    'byte_offset': int(packet.get('pos', -1)),
-                    'pts_time': float(packet.get('pts_time', 0)),
-                    'packet_size': int(packet.get('size', 0))
+                    'byte_offset': _probe_number(packet, 'pos', int, -1),
+                    'pts_time': _probe_number(packet, 'pts_time', float, 0),
+                    'packet_size': _probe_number(packet, 'size', int, 0)
                 }
                 keyframes.append(keyframe_info)
             frame_num += 1
-        
-        return keyframes
-    
-    except subprocess.CalledProcessError as e:
+        elif line.startswith(b'format|'):
+            duration = _probe_number(dict([line.decode().rstrip('\n').split('|', 1)[1].split('=', 1)]), 'duration', float, 0.0)
+
+    return keyframes, duration
+
+def _report_probe_error(e):
+    if isinstance(e, subprocess.CalledProcessError):
         print(f"Error running ffprobe: {e}")
         if e.stderr:
             print(f"ffprobe stderr: {e.stderr}")
         if e.stdout:
             print(f"ffprobe stdout: {e.stdout}")
+    else:
+        print(f"Error parsing ffprobe output: {e}")
+
+# this will give you the keyframes and their data
+def extract_keyframe_offsets(video_path, video_file):
+    """
+    Extract keyframe information including byte offsets from a video file.
+    
+    Returns:
+        tuple: List of dictionaries containing keyframe metadata, and the
+        container duration in seconds
+    """
+    cmd = _probe_cmd(video_path)
+    
+    try:
+        # Stream the listing instead of holding the whole output in memory;
+        # a corrupt file can log more errors than the stderr pipe holds, so a
+        # thread drains it while stdout is parsed
+        proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        stderr_chunks = []
+        reader = threading.Thread(target = lambda: stderr_chunks.append(proc.stderr.read()), daemon = True)
+        reader.start()
+        parsed = False
+        try:
+            keyframes, duration = _parse_probe_lines(proc.stdout)
+            parsed = True
+        finally:
+            # a parse error must not leave ffprobe running
+            if not parsed:
+                proc.kill()
+            proc.wait()
+            reader.join()
+            proc.stdout.close()
+            proc.stderr.close()
+
+        stderr = b''.join(stderr_chunks).decode(errors = 'replace')
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr = stderr)
+        if stderr:
+            print("ffprobe stderr:", stderr)
+        
+        return keyframes, duration
+    
+    except (subprocess.CalledProcessError, ValueError) as e:
+        _report_probe_error(e)
         raise
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON output: {e}")
+
+async def _probe_async(video_path, limit):
+    cmd = _probe_cmd(video_path)
+    async with limit:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        out, err = await proc.communicate()
+    
+    try:
+        stderr = err.decode(errors = 'replace')
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr = stderr)
+        if stderr:
+            print(f"ffprobe stderr ({video_path}):", stderr)
+        return _parse_probe_lines(out.splitlines())
+    except (subprocess.CalledProcessError, ValueError) as e:
+        _report_probe_error(e)
         raise
 
+def probe_videos(video_paths, max_concurrent=None):
+    """Run the keyframe probe for many videos at once; returns {video_path: (keyframes, duration)}
+
+    Videos that fail to probe are reported and left out of the result.
+    """
+    async def probe_all():
+        # Each ffprobe mostly waits on disk reads, so overlapping them keeps
+        # the disk busy instead of paying one cold start after another
+        limit = asyncio.Semaphore(max_concurrent or os.cpu_count() or 4)
+        # one unreadable video must not abort the probes of the others
+        return await asyncio.gather(*[_probe_async(v, limit) for v in video_paths], return_exceptions = True)
+    probes = {}
+    for video_path, result in zip(video_paths, asyncio.run(probe_all())):
+        if isinstance(result, Exception):
+            # ffprobe failures were already reported with their stderr
+            print(f"Skipping {video_path}: probe failed ({type(result).__name__})")
+        else:
+            probes[video_path] = result
+    return probes
+
+def _probe_number(fields, key, cast, default):
+    """ffprobe prints N/A for missing values; fall back like the JSON output did."""
+    value = fields.get(key, 'N/A')
+    return default if value == 'N/A' else cast(value)
+
 # check if there is a frames folder, if not, the create one
 
 def save_keyframes(keyframes, video_file):
@@ -97,126 +176,208 @@ def save_keyframes(keyframes, video_file):
     frames_folder_path = f'{context_folder_path}/{video_file}/frames'
     keyframes_path = f'{context_folder_path}/{video_file}/frames/keyframes.json'
 
-    if not os.path.exists(frames_folder_path):
-        os.makedirs(frames_folder_path)
-
-        # check if it has the keyframes file for this video file
-        if os.path.exists(keyframes_path):
-            print(f"Keyframes file already exists for {video_file}")
-            with open(keyframes_path, 'w') as f:
-                json.dump(keyframes, f)
-        else:
-            with open(keyframes_path, 'w') as f:
-                json.dump(keyframes, f)
-    else:
-        if os.path.exists(keyframes_path):
-            print(f"Keyframes file already exists for {video_file}")
-            with open(keyframes_path, 'w') as f:
-                json.dump(keyframes, f)
-        else:
-            with open(keyframes_path, 'w') as f:
-                json.dump(keyframes, f)
+    os.makedirs(frames_folder_path, exist_ok=True)
+    with open(keyframes_path, 'wb') as f:
+        f.write(orjson.dumps(keyframes))
 
 # we need 2 more intermediate frames in between the keyframes for more context
-def get_all_frames(keyframes, video_path, video_file):
-    all_frames = []
+def get_all_frames(keyframes, duration, video_file):
     all_frames_path = f'{context_folder_path}/{video_file}/frames/all_frames.json'
-    for i in range(len(keyframes)):
-        if i == 0:
-            all_frames.append(f"{keyframes[i]['pts_time']:.2f}")
-        elif i == len(keyframes) - 1:
-            # find the duration of the video
-            t0 = keyframes[i]['pts_time']
-            cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', video_path]
-            t1 = float(subprocess.check_output(cmd).decode('utf-8')) - 0.1
-            t_inter_1 = t0 + (t1 - t0) / 3
-            t_inter_2 = t0 + (2 * (t1 - t0)) / 3
-            t_inter_2 = t_inter_2
-            all_frames.append(f"{t0:.2f}")
-            all_frames.append(f"{t_inter_1:.2f}")
-            all_frames.append(f"{t_inter_2:.2f}")
-            all_frames.append(f"{t1:.2f}")
-        else:
-            t0 = keyframes[i]['pts_time']
-            t1 = keyframes[i+1]['pts_time']
-            t_inter_1 = t0 + (t1 - t0) / 3
-            t_inter_2 = t0 + (2 * (t1 - t0)) / 3
-            all_frames.append(f"{t0:.2f}")
-            all_frames.append(f"{t_inter_1:.2f}")
-            all_frames.append(f"{(t_inter_2):.2f}")
+    pts = np.fromiter((k['pts_time'] for k in keyframes), dtype=np.float64, count=len(keyframes))
+    if len(pts) < 2:
+        all_frames = pts.round(2).tolist()
+    else:
+        # every keyframe after the first gets its two thirds points up to the
+        # next keyframe; the last one runs to just before the end of the video
+        t0 = pts[1:-1]
+        d = pts[2:] - t0
+        middle = np.column_stack([t0, t0 + d / 3, t0 + 2 * d / 3]).ravel()
+        t_last = pts[-1]
+        if duration <= t_last:
+            # no usable container duration; assume one more keyframe interval
+            duration = t_last + (t_last - pts[-2])
+        t1 = duration - 0.1
+        tail = [t_last, t_last + (t1 - t_last) / 3, t_last + 2 * (t1 - t_last) / 3, t1]
+        all_frames = np.concatenate([pts[:1], middle, tail]).round(2).tolist()
     # save it on the file named all_frames.json
     print('about to add all_frames')
-    with open(all_frames_path, 'w') as f:
-        json.dump(all_frames, f)
+    with open(all_frames_path, 'wb') as f:
+        f.write(orjson.dumps(all_frames))
         print("saved all frames")
 
 # make images folder
 def make_images_folder(images_folder):
-    if not os.path.exists(images_folder):
-        os.makedirs(images_folder)
-        print("made the images folder")
-    else:
-        print("images folder already exists")
+    os.makedirs(images_folder, exist_ok=True)
 
-# extract images
-def extract_frames(video_path, all_frames_path, images_path):
-    # Open the video file once
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        print(f"Error: Could not open video {video_path}")
-        return
+# run one ffmpeg decode and split its MJPEG output back into frames
+def _iter_jpegs(video_path, input_args, filter_args):
+    """Yield (pts_time, jpeg_bytes) for every frame ffmpeg writes, in output order."""
+    cmd = [
+        ffmpeg, '-hide_banner', '-y',
+        *input_args,
+        '-i', video_path,
+        '-an',
+        *filter_args,
+        '-vsync', '0',
+        '-f', 'image2pipe', '-c:v', 'mjpeg',  # JPEGs back to back on stdout
+        '-q:v', '3',
+        '-'
+    ]
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
 
-    with open(all_frames_path, 'r') as f:
-        all_frames = json.load(f)
-        
-        for time_str in all_frames:
-            try:
-                # Convert time string to float seconds, then to milliseconds
-                time_sec = float(time_str)
-                time_msec = time_sec * 1000.0
-                
-                # Seek to the specific time
-                cap.set(cv2.CAP_PROP_POS_MSEC, time_msec)
-                
-                # Read the frame
-                ret, frame = cap.read()
-                
-                if ret:
-                    output_filename = f'{images_path}/{time_str}.jpg'
-                    cv2.imwrite(output_filename, frame)
-                    # print(f"Saved {output_filename}") # Optional logging
+    # showinfo logs each selected frame's pts_time before it is encoded; a
+    # reader thread hands them over in output order and keeps stderr drained
+    frame_times = queue.Queue()
+    stderr_tail = []
+    def read_stderr():
+        try:
+            for line in proc.stderr:
+                if b'pts_time:' in line:
+                    try:
+                        pts = float(line.split(b'pts_time:', 1)[1].split(None, 1)[0])
+                    except ValueError:
+                        # pts_time:NOPTS; keep the slot so later frames stay paired
+                        pts = math.nan
+                    frame_times.put(pts)
                 else:
-                    print(f"Warning: Could not read frame at {time_str}s")
-            except ValueError as e:
-                print(f"Error processing time {time_str}: {e}")
+                    stderr_tail.append(line)
+                    del stderr_tail[:-20]
+        finally:
+            # the generator blocks on this queue, so the sentinel must always arrive
+            frame_times.put(None)
+    reader = threading.Thread(target = read_stderr, daemon = True)
+    reader.start()
+
+    buf = bytearray()
+    scan = 0
+    try:
+        while chunk := proc.stdout.read1(1 << 20):
+            buf += chunk
+            # Entropy-coded data byte-stuffs 0xFF, so FF D9 only ever marks the
+            # end of an image
+            while (end := buf.find(b'\xff\xd9', scan)) != -1:
+                jpeg = bytes(buf[:end + 2])
+                del buf[:end + 2]
+                scan = 0
+                pts = frame_times.get()
+                if pts is None:
+                    # ffmpeg stopped logging; leave the marker for the next frame
+                    frame_times.put(None)
+                    continue
+                # a frame without a timestamp cannot be named or matched
+                if math.isnan(pts):
+                    continue
+                yield pts, jpeg
+            scan = max(len(buf) - 1, 0)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        reader.join()
+
+    if proc.returncode != 0:
+        print(f"Error: ffmpeg could not extract frames from {video_path}")
+        print(f"ffmpeg stderr: {b''.join(stderr_tail).decode(errors = 'replace')}")
+
+# decode the requested frames straight into memory
+def iter_frames(video_path, times):
+    """Yield (timestamp, jpeg_bytes) for each requested time, from one ffmpeg pass."""
+    # Timestamps are stored as floats; they only become strings in file names
+    targets = sorted(set(times))
+    if not targets:
+        return
+
+    # One decode pass: keep the first frame at or after each timestamp, the
+    # same frame a seek to that time would have returned
+    select_expr = "+".join(f"gte(t,{t})*(lt(prev_t,{t})+isnan(prev_t))" for t in targets)
+    with tempfile.NamedTemporaryFile('w', suffix = '.txt', delete = False) as f:
+        f.write(f"select='{select_expr}',showinfo")
+        filter_script = f.name
+
+    i = 0
+    try:
+        for pts, jpeg in _iter_jpegs(
+                video_path,
+                # Seek straight to the earliest timestamp; copyts keeps t absolute
+                ['-ss', f'{targets[0]}', '-copyts'],
+                ['-filter_script:v', filter_script]):  # the expression can outgrow the command line
+            # Several timestamps can land on the same frame; each gets it
+            while i < len(targets) and targets[i] - 1e-6 <= pts:
+                yield targets[i], jpeg
+                i += 1
+    finally:
+        os.remove(filter_script)
+
+    for t in targets[i:]:
+        print(f"Warning: Could not read frame at {t:.2f}s")
+
+# decode only the keyframes; the decoder drops every other frame unseen
+def iter_keyframes(video_path):
+    """Yield (pts_time, jpeg_bytes) for every keyframe, decoding nothing else."""
+    yield from _iter_jpegs(video_path, ['-skip_frame', 'nokey'], ['-vf', 'showinfo'])
+
+# extract images
+def extract_frames(video_path, all_frames_path, images_path, frame_queue=None, keyframes_only=False):
+    if keyframes_only:
+        frames = iter_keyframes(video_path)
+    else:
+        with open(all_frames_path, 'r') as f:
+            frames = iter_frames(video_path, json.load(f))
+
+    # Frames arrive already encoded, so they go to disk once under their
+    # final name instead of being written and renamed
+    def write_frame(image_file, jpeg):
+        with open(f'{images_path}/{image_file}', 'wb') as f:
+            f.write(jpeg)
+        # let a consumer start on each frame as soon as it is on disk
+        if frame_queue is not None:
+            frame_queue.put(image_file)
+
+    # File writes release the GIL, so the pool keeps the disk busy while
+    # this thread goes on draining ffmpeg's pipe
+    with ThreadPoolExecutor(max_workers = min(16, os.cpu_count() or 1)) as save_executor:
+        futures = [save_executor.submit(write_frame, f'{t:.2f}.jpg', jpeg) for t, jpeg in frames]
+    for future in futures:
+        future.result()
 
-    cap.release()
     print("Frame extraction complete.")
 
 def make_video_context_folder(video_path):
     file_name = Path(video_path).name
     video_folder = f'{context_folder_path}/{file_name}'
-    if not os.path.exists(video_folder):
-        os.makedirs(video_folder)
-    else:
-        print("video folder folder already exists")
+    os.makedirs(video_folder, exist_ok=True)
 
-def execute(video_path = "C:/Users/Kuntal/Downloads/demo.mp4"):
-    # verify_video_path(video_path)
-    if not os.path.exists(video_path):
-        print(f"ERROR: Video file not found at {video_path}")
-        return
-    
-    # make a folder for the video
-    video_file = Path(video_path).name
-    images_folder = f'{context_folder_path}/{video_file}/images'
-    all_frames_path = f'{context_folder_path}/{video_file}/frames/all_frames.json'
-    make_video_context_folder(video_path)
-    keyframes = extract_keyframe_offsets(video_path, video_file)
-    save_keyframes(keyframes, video_file)
-    get_all_frames(keyframes, video_path, video_file)
-    make_images_folder(images_folder)
-    extract_frames(video_path, all_frames_path, images_folder)
+def execute(video_path = "C:/Users/Kuntal/Downloads/demo.mp4", probe=None, frame_queue=None, keyframes_only=False):
+    try:
+        # verify_video_path(video_path)
+        if not os.path.exists(video_path):
+            print(f"ERROR: Video file not found at {video_path}")
+            return
+        
+        # make a folder for the video
+        video_file = Path(video_path).name
+        images_folder = f'{context_folder_path}/{video_file}/images'
+        all_frames_path = f'{context_folder_path}/{video_file}/frames/all_frames.json'
+        make_video_context_folder(video_path)
+        keyframes, duration = probe or extract_keyframe_offsets(video_path, video_file)
+        save_keyframes(keyframes, video_file)
+        # keyframe-only runs name images by pts, so no timestamp list is needed
+        if not keyframes_only:
+            get_all_frames(keyframes, duration, video_file)
+        make_images_folder(images_folder)
+        extract_frames(video_path, all_frames_path, images_folder, frame_queue=frame_queue,
+                       keyframes_only=keyframes_only)
+    finally:
+        # None tells the consumer no more frames are coming, however this ended
+        if frame_queue is not None:
+            frame_queue.put(None)
+
+def execute_many(video_paths):
+    """Extract frames for several videos, probing all of them concurrently first"""
+    video_paths = [v for v in video_paths if os.path.exists(v)]
+    probes = probe_videos(video_paths)
+    for video_path in video_paths:
+        if video_path in probes:
+            execute(video_path, probe=probes[video_path])
 
 if __name__ == "__main__":
     execute()
\ No newline at end of file
@@ -1,17 +1,22 @@
 import json
 import os
+import asyncio
 import csv
 import base64
+import mmap
 from pathlib import Path
 import ollama
+import orjson
 
 HOME = Path.home()
 CONTEXT_FOLDER_PATH = f'{HOME}/context'
+# Keep the model resident between the frame descriptions and the synthesis
+KEEP_ALIVE = "10m"
 
 def encode_image(image_path):
     """Encode image to base64 for Ollama"""
     with open(image_path, "rb") as image_file:
-        return base64.standard_b64encode(image_file.read()).decode("utf-8")
+        return base64.b64encode(image_file.read()).decode("ascii")
 
 def get_full_transcript(video_file):
     """Get complete transcript for the video from WhisperX results"""
@@ -21,24 +26,30 @@ def get_full_transcript(video_file):
         return "No transcript available"
     
     try:
-        with open(csv_path, 'r') as f:
-            rows = list(csv.DictReader(f))
-        
         transcript_lines = []
         current_line = []
         last_ts = 0
         
-        for r in rows:
-            ts = float(r['start_sec'])
-            word = r['word']
-            
-            # Group words every 10 seconds for readability
-            if ts - last_ts > 10 and current_line:
-                transcript_lines.append(f"[{int(last_ts)}s] {' '.join(current_line)}")
-                current_line = []
-                last_ts = ts
+        with open(csv_path, 'r', newline='') as f:
+            # Plain rows streamed straight from the file, no dict per word
+            reader = csv.reader(f)
+            header = next(reader)
+            i_start, i_word = header.index('start_sec'), header.index('word')
             
-            current_line.append(word)
+            for row in reader:
+                # csv.reader yields [] for a blank line, which DictReader skipped
+                if not row:
+                    continue
+                ts = float(row[i_start])
+                word = row[i_word]
+                
+                # Group words every 10 seconds for readability
+                if ts - last_ts > 10 and current_line:
+                    transcript_lines.append(f"[{int(last_ts)}s] {' '.join(current_line)}")
+                    current_line = []
+                    last_ts = ts
+                
+                current_line.append(word)
         
         if current_line:
             transcript_lines.append(f"[{int(last_ts)}s] {' '.join(current_line)}")
@@ -56,127 +67,188 @@ def sample_keyframes(video_file, max_frames=8):
         print(f"Images folder not found: {images_folder_path}")
         return []
     
-    images = [f for f in os.listdir(images_folder_path) 
-              if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    images.sort(key=lambda x: float(Path(x).stem))
+    # One directory pass; each timestamp is parsed once and sorts the paths with it
+    with os.scandir(images_folder_path) as it:
+        images = [(float(e.name.rsplit('.', 1)[0]), e.path)
+                  for e in it if e.name.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    images.sort()
     
     if len(images) <= max_frames:
-        sampled = images
-    else:
-        step = len(images) / (max_frames - 1)
-        indices = [int(i * step) for i in range(max_frames - 1)]
-        indices.append(len(images) - 1)
-        sampled = [images[i] for i in sorted(list(set(indices)))]
-    
-    return [(float(Path(img).stem), os.path.join(images_folder_path, img)) 
-            for img in sampled]
+        return images
+
+    step = len(images) / (max_frames - 1)
+    indices = [int(i * step) for i in range(max_frames - 1)]
+    indices.append(len(images) - 1)
+    return [images[i] for i in sorted(set(indices))]
 
-def _get_frame_description(img_path, timestamp):
+async def _get_frame_description(client, img_bytes, timestamp):
     """Get a brief description of a single frame using Gemma 3:4b vision"""
     prompt = f"Describe this video frame at {timestamp:.2f}s precisely. Identify people, visible text, and the setting."
     
     try:
-        resp = ollama.chat(
+        resp = await client.chat(
             model="gemma3:4b",
             messages=[{
                 "role": "user",
                 "content": prompt,
-                "images": [img_path]
+                "images": [img_bytes]
             }],
-            options={"temperature": 0.1}
+            options={"temperature": 0.1},
+            keep_alive=KEEP_ALIVE
         )
         return resp['message']['content'].strip()
     except Exception as e:
         print(f"Error describing frame {timestamp}: {e}")
         return f"Frame at {timestamp}s: analysis failed."
 
-def build_global_context(video_file):
+def _prefetch_frames(img_paths):
+    """Ask the kernel to start reading every sampled frame before it is needed"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for img_path in img_paths:
+        try:
+            fd = os.open(img_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def _read_frame(img_path):
+    """Read a frame through a read-only mapping of the (prefetched) file"""
+    with open(img_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return bytes(mm)
+
+async def _describe_frames(sampled_frames, max_prefetch=2):
+    """Describe all sampled frames concurrently, in sampling order"""
+    workers = max(len(sampled_frames), 1)
+    frames = asyncio.Queue(maxsize=max_prefetch)
+    descriptions = [None] * len(sampled_frames)
+
+    async def producer():
+        # Reads the next frames off disk while earlier ones are with the model.
+        # Raw bytes are encoded once by the client; a path would make it stat
+        # and read the file inside the event loop while building the request
+        await asyncio.to_thread(_prefetch_frames, [img_path for _, img_path in sampled_frames])
+        for i, (ts, img_path) in enumerate(sampled_frames):
+            print(f"  🔍 Analyzing frame at {ts:.2f}s...")
+            try:
+                img_bytes = await asyncio.to_thread(_read_frame, img_path)
+            except (OSError, ValueError) as e:
+                print(f"Error describing frame {ts}: {e}")
+                descriptions[i] = f"Frame at {ts}s: analysis failed."
+                continue
+            await frames.put((i, ts, img_bytes))
+        for _ in range(workers):
+            await frames.put(None)
+
+    async def consumer(client):
+        while (item := await frames.get()) is not None:
+            i, ts, img_bytes = item
+            descriptions[i] = await _get_frame_description(client, img_bytes, ts)
+
+    async with ollama.AsyncClient() as client:
+        await asyncio.gather(producer(), *[consumer(client) for _ in range(workers)])
+    return descriptions
+
+def build_global_context(video_file, wait_for_transcript=None):
     """
     Two-pass context builder for Gemma 3:4b:
     1. Direct visual analysis of sampled frames.
     2. Textual synthesis of frame descriptions + full transcript.
+
+    Pass 1 only needs the images; if the transcript is still being produced,
+    `wait_for_transcript` is called just before it is read.
     """
     print(f"\n🌍 Phase 1: Analyzing key visual frames for {video_file}...")
     sampled_frames = sample_keyframes(video_file, max_frames=8)
-    
-    frame_descriptions = []
-    for ts, img_path in sampled_frames:
-        print(f"  🔍 Analyzing frame at {ts:.2f}s...")
-        desc = _get_frame_description(img_path, ts)
-        frame_descriptions.append(f"- At {ts:.2f}s: {desc}")
+    descriptions = asyncio.run(_describe_frames(sampled_frames))
+    frame_descriptions = [f"- At {ts:.2f}s: {desc}"
+                          for (ts, _), desc in zip(sampled_frames, descriptions)]
     
     all_frame_desc = "\n".join(frame_descriptions)
+    if wait_for_transcript is not None:
+        wait_for_transcript()
     transcript = get_full_transcript(video_file)
     
     print(f"\n🌍 Phase 2: Synthesizing global context for {video_file}...")
     return _synthesize_context(all_frame_desc, transcript)
 
-def _synthesize_context(frame_descriptions, transcript):
-    """Synthesize visual and audio data into a robust global context JSON"""
-    prompt = f"""You are an expert video indexer. Combine the visual frame descriptions and the audio transcript to build a detailed Global Context.
-
-VISUAL DESCRIPTIONS:
-{frame_descriptions}
-
-AUDIO TRANSCRIPT:
-{transcript}
+# Fixed instructions and schema go in the system message so the served
+# model can keep their KV cache between videos
+_SYNTH_SYSTEM = """You are an expert video indexer. Combine the visual frame descriptions and the audio transcript to build a detailed Global Context.
 
 TASK:
 Identify the primary speaker(s), their names (look for self-intros or text overlays), roles, the video's style, and key events. 
 CRITICAL: If someone says "I am [Name]" or text shows a name, use it. Do NOT use generic terms like "narrator" if the person is on screen.
 
 Return ONLY a JSON object:
-{{
+{
   "summary": "2-3 sentence overview",
-  "entities": {{
+  "entities": {
     "people": [
-      {{
+      {
         "name": "Full name",
         "role": "speaker/subject",
         "description": "appearance/identity",
         "appearance_timestamps": [list of floats]
-      }}
+      }
     ],
     "locations": ["places shown"],
     "objects": ["key items"]
-  }},
+  },
   "narrative_style": "interview/vlog/presentation/etc",
-  "speaker_map": {{
+  "speaker_map": {
     "start_time-end_time": "Speaker Name"
-  }},
+  },
   "key_moments": [
-    {{
+    {
       "timestamp": float,
       "description": "what happened"
-    }}
+    }
   ]
-}}
+}
 """
+
+_SYNTH_PROMPT = """VISUAL DESCRIPTIONS:
+{visual}
+
+AUDIO TRANSCRIPT:
+{transcript}
+"""
+
+def _synthesize_context(frame_descriptions, transcript):
+    """Synthesize visual and audio data into a robust global context JSON"""
     try:
         resp = ollama.chat(
             model="gemma3:4b",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[
+                {"role": "system", "content": _SYNTH_SYSTEM},
+                {"role": "user", "content": _SYNTH_PROMPT.format(visual=frame_descriptions, transcript=transcript)}
+            ],
             format="json",
-            options={"temperature": 0.2}
+            options={"temperature": 0.2},
+            keep_alive=KEEP_ALIVE
         )
         return json.loads(resp['message']['content'])
     except Exception as e:
         print(f"❌ Synthesis failed: {e}")
-        return {{
+        return {
             "summary": "Video context synthesis failed",
-            "entities": {{"people": [], "locations": [], "objects": []}},
+            "entities": {"people": [], "locations": [], "objects": []},
             "narrative_style": "unknown",
-            "speaker_map": {{}},
+            "speaker_map": {},
             "key_moments": []
-        }}
+        }
 
 def save_global_context(video_file, context):
     """Save global context to the designated folder"""
     output_path = Path(CONTEXT_FOLDER_PATH) / video_file / "global_context.json"
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(output_path, 'w') as f:
-        json.dump(context, f, indent=4)
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(context, option=orjson.OPT_INDENT_2))
     print(f"✅ Global context saved: {output_path}")
 
 def load_global_context(video_file):
@@ -187,14 +259,14 @@ def load_global_context(video_file):
             return json.load(f)
     return None
 
-def execute(video_file, use_claude=False, force_rebuild=False, **kwargs):
+def execute(video_file, use_claude=False, force_rebuild=False, wait_for_transcript=None, **kwargs):
     """Entry point for the pipeline"""
     if not force_rebuild:
         existing = load_global_context(video_file)
         if existing:
             return existing
             
-    context = build_global_context(video_file)
+    context = build_global_context(video_file, wait_for_transcript=wait_for_transcript)
     save_global_context(video_file, context)
     return context
 
@@ -3,13 +3,86 @@ Debug helper for captioning issues
 Helps diagnose why Ollama might be returning empty JSON
 """
 
-import json
+import contextlib
+import functools
+import io
+import mmap
+import orjson
 import os
+import re
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 HOME = Path.home()
 CONTEXT_FOLDER_PATH = f'{HOME}/context'
 
+# Top-level keys every caption is expected to have
+REQUIRED_FIELDS = frozenset({'scene', 'objects', 'people', 'actions', 'emotion', 'lighting'})
+
+# <seconds>.<ext>, e.g. 12.34.jpg; anything else is not a frame timestamp
+TIMESTAMP_FILENAME = re.compile(r'^(?P<ts>\d+(?:\.\d*)?|\.\d+)\.(?:png|jpe?g)$', re.I)
+
+def buffered_output(func):
+    """Collect everything a diagnostics pass prints and write it out in one go"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        buf = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(buf):
+                return func(*args, **kwargs)
+        finally:
+            sys.stdout.write(buf.getvalue())
+            sys.stdout.flush()
+    return wrapper
+
+def prefetch_files(paths):
+    """Queue kernel readahead for every file up front so the serial reads mostly hit the page cache"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def _classify(data):
+    """Classify a parsed caption; returns (status, issue or None)"""
+    # Check if empty
+    if not data or data == {}:
+        return "empty", "Empty JSON"
+    
+    # Check if it has 'raw_content' (means JSON parsing failed in captioning)
+    if 'raw_content' in data:
+        return "raw_content", "Has raw_content wrapper - JSON parsing failed"
+    
+    # Check if it has explicit error field
+    if 'error' in data:
+        return "error", f"Error: {data['error']}"
+    
+    # Validate against expected schema
+    missing_fields = REQUIRED_FIELDS.difference(data)
+    if missing_fields:
+        return "missing", f"Missing fields: {sorted(missing_fields)}"
+    
+    return "valid", None
+
+def _check_one(file_path):
+    """Check a single caption file; returns (status, issue or None)"""
+    try:
+        with open(file_path, 'rb') as f:
+            return _classify(orjson.loads(f.read()))
+    except orjson.JSONDecodeError as e:
+        return "error", f"Invalid JSON: {str(e)[:50]}"
+    except Exception as e:
+        return "error", f"Error reading: {str(e)[:50]}"
+
+@buffered_output
 def check_caption_folder(video_file):
     """Check caption folder for issues"""
     
@@ -23,67 +96,21 @@ def check_caption_folder(video_file):
         print(f"⚠️ Caption folder doesn't exist yet: {caption_path}")
         return
     
-    caption_files = [f for f in os.listdir(caption_path) if f.endswith('.json')]
+    with os.scandir(caption_path) as it:
+        caption_files = [(e.name, e.path) for e in it if e.name.endswith('.json')]
     
     print(f"Total caption files: {len(caption_files)}")
+    prefetch_files([path for _, path in caption_files])
     
-    # Check for empty captions
-    empty_count = 0
-    error_count = 0
-    valid_count = 0
-    raw_content_count = 0
+    # Every file is checked independently, so overlap their reads
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = list(executor.map(_check_one, [path for _, path in caption_files]))
     
-    issues = []
-    
-    for cf in caption_files:
-        with open(os.path.join(caption_path, cf), 'r') as f:
-            try:
-                data = json.load(f)
-                
-                # Check if empty
-                if not data or data == {}:
-                    empty_count += 1
-                    issues.append((cf, "Empty JSON"))
-                    continue
-                
-                # Check if it has 'raw_content' (means JSON parsing failed in captioning)
-                if 'raw_content' in data:
-                    raw_content_count += 1
-                    error_count += 1
-                    issues.append((cf, "Has raw_content wrapper - JSON parsing failed"))
-                    continue
-                
-                # Check if it has explicit error field
-                if 'error' in data:
-                    error_count += 1
-                    issues.append((cf, f"Error: {data['error']}"))
-                    continue
-                
-                # Validate against expected schema
-                required_fields = ['scene', 'objects', 'people', 'actions', 'emotion', 'lighting']
-                missing_fields = [field for field in required_fields if field not in data]
-                
-                if missing_fields:
-                    error_count += 1
-                    issues.append((cf, f"Missing fields: {missing_fields}"))
-                    continue
-                
-                # Check if people have proper structure
-                if 'people' in data and isinstance(data['people'], list):
-                    for person in data['people']:
-                        # Check if person is missing 'type' field (should have name/type)
-                        if isinstance(person, dict) and 'type' not in person and 'name' not in person:
-                            # This is suspicious but not necessarily invalid
-                            pass
-                
-                valid_count += 1
-                
-            except json.JSONDecodeError as e:
-                error_count += 1
-                issues.append((cf, f"Invalid JSON: {str(e)[:50]}"))
-            except Exception as e:
-                error_count += 1
-                issues.append((cf, f"Error reading: {str(e)[:50]}"))
+    # One tally keyed by status; per-worker Counters would simply add up
+    stats = Counter(status for status, _ in results)
+    valid_count = stats['valid']
+    empty_count = stats['empty']
+    error_count = stats['error'] + stats['raw_content'] + stats['missing']
     
     print(f"  Valid captions: {valid_count}")
     print(f"  Empty captions: {empty_count}")
@@ -110,8 +137,8 @@ def check_image_filenames(video_file):
         print(f"❌ Images folder not found: {images_path}")
         return
     
-    images = [f for f in os.listdir(images_path) 
-              if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    with os.scandir(images_path) as it:
+        images = [e.name for e in it if e.name.lower().endswith(('.png', '.jpg', '.jpeg'))]
     
     print(f"Total images: {len(images)}")
     
@@ -120,10 +147,10 @@ def check_image_filenames(video_file):
     valid_timestamps = []
     
     for img in images:
-        try:
-            ts = float(Path(img).stem)
-            valid_timestamps.append((ts, img))
-        except ValueError:
+        m = TIMESTAMP_FILENAME.match(img)
+        if m:
+            valid_timestamps.append((float(m['ts']), img))
+        else:
             print(f"  ⚠️ Invalid timestamp filename: {img}")
             invalid_count += 1
     
@@ -137,6 +164,7 @@ def check_image_filenames(video_file):
     else:
         print(f"❌ Found {invalid_count} invalid filenames")
 
+@buffered_output
 def fix_raw_content_captions(video_file, dry_run=True):
     """
     Fix captions that have raw_content wrapper
@@ -156,16 +184,22 @@ def fix_raw_content_captions(video_file, dry_run=True):
         print(f"❌ Caption folder not found: {caption_path}")
         return
     
-    caption_files = [f for f in os.listdir(caption_path) if f.endswith('.json')]
+    with os.scandir(caption_path) as it:
+        caption_files = [(e.name, e.path) for e in it if e.name.endswith('.json')]
     
     fixed_count = 0
     failed_count = 0
-    
-    for cf in caption_files:
-        file_path = os.path.join(caption_path, cf)
-        
-        with open(file_path, 'r') as f:
-            data = json.load(f)
+    staged = []
+    
+    for cf, file_path in caption_files:
+        # Most captions are fine; a byte scan rules them out without parsing
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b'"raw_content"') < 0:
+                    continue
+                data = orjson.loads(mm[:])
         
         # Check if it has raw_content
         if 'raw_content' not in data:
@@ -178,22 +212,23 @@ def fix_raw_content_captions(video_file, dry_run=True):
             raw_content = data['raw_content']
             
             # Try to parse it as JSON
-            parsed = json.loads(raw_content)
+            parsed = orjson.loads(raw_content)
             
             print(f"   ✅ Successfully parsed raw_content")
             print(f"   Fields: {list(parsed.keys())}")
             
             if not dry_run:
-                # Save the fixed version
-                with open(file_path, 'w') as f:
-                    json.dump(parsed, f, indent=4)
+                # Stage the fixed version next to the original; it replaces
+                # the original only once every staged file is on disk
+                Path(f'{file_path}.tmp').write_bytes(orjson.dumps(parsed, option=orjson.OPT_INDENT_2))
+                staged.append(file_path)
                 print(f"   💾 Saved fixed version")
             else:
                 print(f"   🔍 Would save: {list(parsed.keys())}")
             
             fixed_count += 1
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"   ❌ Failed to parse: {str(e)[:100]}")
             print(f"   Raw content preview: {raw_content[:200]}...")
             failed_count += 1
@@ -201,6 +236,14 @@ def fix_raw_content_captions(video_file, dry_run=True):
             print(f"   ❌ Error: {e}")
             failed_count += 1
     
+    # One flush for the whole batch instead of one per file, then swap each
+    # file in atomically so a crash never leaves a truncated caption
+    if staged:
+        if hasattr(os, 'sync'):
+            os.sync()
+        for file_path in staged:
+            os.replace(f'{file_path}.tmp', file_path)
+    
     print(f"\n{'='*60}")
     print("SUMMARY")
     print(f"{'='*60}")
@@ -211,6 +254,7 @@ def fix_raw_content_captions(video_file, dry_run=True):
         print(f"\n💡 To apply fixes, run:")
         print(f"   fix_raw_content_captions('{video_file}', dry_run=False)")
 
+@buffered_output
 def inspect_caption(video_file, frame_name):
     """Inspect a specific caption file in detail"""
     
@@ -224,14 +268,15 @@ def inspect_caption(video_file, frame_name):
         print(f"❌ Caption file not found: {caption_path}")
         return
     
-    with open(caption_path, 'r') as f:
-        content = f.read()
+    # Size comes from stat; the bytes go to orjson as-is, without a str copy
+    print(f"File size: {os.stat(caption_path).st_size} bytes\n")
     
-    print(f"File size: {len(content)} bytes\n")
+    with open(caption_path, 'rb') as f:
+        content = f.read()
     
     # Try to parse as JSON
     try:
-        data = json.loads(content)
+        data = orjson.loads(content)
         print("✅ Valid JSON file\n")
         
         print("Top-level keys:")
@@ -256,7 +301,7 @@ def inspect_caption(video_file, frame_name):
             
             # Try to parse the raw content
             try:
-                parsed = json.loads(data['raw_content'])
+                parsed = orjson.loads(data['raw_content'])
                 print(f"\n✅ Raw content IS valid JSON with keys: {list(parsed.keys())}")
                 print("💡 This can be auto-fixed with fix_raw_content_captions()")
             except:
@@ -265,10 +310,9 @@ def inspect_caption(video_file, frame_name):
         if 'error' in data:
             issues.append(f"❌ Has error field: {data['error']}")
         
-        required_fields = ['scene', 'objects', 'people', 'actions', 'emotion', 'lighting']
-        missing = [f for f in required_fields if f not in data]
+        missing = REQUIRED_FIELDS.difference(data)
         if missing:
-            issues.append(f"❌ Missing required fields: {missing}")
+            issues.append(f"❌ Missing required fields: {sorted(missing)}")
         
         if issues:
             print(f"\n⚠️  Issues found:")
@@ -277,16 +321,14 @@ def inspect_caption(video_file, frame_name):
         else:
             print(f"\n✅ No issues detected")
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"❌ INVALID JSON FILE\n")
         print(f"Error: {e}\n")
         print(f"File content preview (first 500 chars):")
-        print(content[:500])
+        print(content[:500].decode(errors='replace'))
         print("...")
 
 if __name__ == "__main__":
-    import sys
-    
     video_file = "demo.mp4"
     
     if len(sys.argv) > 1:
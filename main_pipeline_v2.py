@@ -9,7 +9,9 @@ This pipeline implements a two-pass approach:
 from time import time
 import shutil
 import os
+import heapq
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Core modules
 import frameExtractor as fe 
@@ -46,17 +48,17 @@ def get_transcript(video_path):
     tr.execute(video_path)
     print("✅ Audio transcribed")
 
-def build_global_context(video_file, force_rebuild=False):
+def build_global_context(video_file, force_rebuild=False, wait_for_transcript=None):
     """Build global video context (Pass 1)"""
     print("\n" + "="*60)
     print("PHASE 3: BUILDING GLOBAL CONTEXT")
     print("="*60)
     
-    context = gcb.execute(video_file, force_rebuild=force_rebuild)
+    context = gcb.execute(video_file, force_rebuild=force_rebuild, wait_for_transcript=wait_for_transcript)
     print("✅ Global context built")
     return context
 
-def caption_frames(video_file, max_workers=4):
+def caption_frames(video_file, max_workers=ci_enhanced.OLLAMA_NUM_PARALLEL):
     """Caption frames with global context (Pass 2) - Multithreaded"""
     print("\n" + "="*60)
     print(f"PHASE 4: CAPTIONING FRAMES ({max_workers} workers)")
@@ -77,8 +79,11 @@ def generate_summary_report(video_file, caption_path):
     # Load global context
     global_context = gcb.load_global_context(video_file)
     
-    # Count captions
-    caption_files = [f for f in os.listdir(caption_path) if f.endswith('.json')]
+    # Count captions in one streaming pass, keeping only the names the
+    # sample needs instead of sorting the whole folder
+    with os.scandir(caption_path) as it:
+        caption_files = [e.name for e in it if e.name.endswith('.json')]
+    samples = heapq.nsmallest(3, caption_files)
     
     print(f"\n📊 Results:")
     print(f"   Video: {video_file}")
@@ -87,7 +92,7 @@ def generate_summary_report(video_file, caption_path):
     
     # Sample some captions
     print(f"\n📝 Sample captions:")
-    for i, cf in enumerate(sorted(caption_files)[:3]):
+    for i, cf in enumerate(samples):
         try:
             with open(os.path.join(caption_path, cf), 'r') as f:
                 caption = json.load(f)
@@ -104,7 +109,7 @@ def generate_summary_report(video_file, caption_path):
     
     print("\n✅ Pipeline complete!")
 
-def main(video_file, video_path, skip_extraction=False, force_rebuild_context=False, max_workers=4):
+def main(video_file, video_path, skip_extraction=False, force_rebuild_context=False, max_workers=ci_enhanced.OLLAMA_NUM_PARALLEL):
     """
     Main pipeline orchestrator
     """
@@ -119,15 +124,20 @@ def main(video_file, video_path, skip_extraction=False, force_rebuild_context=Fa
     start_time = time()
     
     try:
-        # Phase 1 & 2: Extract frames and transcribe
         if not skip_extraction:
-            get_frames(str(video_path))
-            get_transcript(str(video_path))
+            # Phase 2 runs in the background for the whole of Phase 1 and the
+            # visual half of Phase 3; only the transcript synthesis and the
+            # captions have to wait for it.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                transcript = executor.submit(get_transcript, str(video_path))
+                get_frames(str(video_path))
+                build_global_context(video_file, force_rebuild=force_rebuild_context,
+                                     wait_for_transcript=transcript.result)
+                transcript.result()
         else:
             print("\n⏭️  Skipping frame extraction/transcription")
-        
-        # Phase 3: Build global context
-        build_global_context(video_file, force_rebuild=force_rebuild_context)
+            # Phase 3: Build global context
+            build_global_context(video_file, force_rebuild=force_rebuild_context)
         
         # Phase 4: Caption frames with context
         caption_path = caption_frames(video_file, max_workers=max_workers)
@@ -157,5 +167,5 @@ if __name__ == "__main__":
         video_path, 
         skip_extraction=True,  # Set to False for first run
         force_rebuild_context=True,
-        max_workers=4
+        max_workers=ci_enhanced.OLLAMA_NUM_PARALLEL
     )
\ No newline at end of file
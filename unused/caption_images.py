@@ -1,16 +1,39 @@
 import ollama
+import asyncio
 import json
+import orjson
 import os
+from itertools import islice
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
+import pandas as pd
 
 # Load schema
 with open("image_caption_schema.json", "r") as f:
     schema = json.load(f)
 
+# The schema never changes, so serialize it into the prompt template once
+_SCHEMA_JSON = json.dumps(schema, indent=2)
+_PROMPT_SUFFIX = (
+    "Analyze the provided image in detail. "
+    "Fill in the following JSON template based on the image content and the provided context:\n"
+    f"{_SCHEMA_JSON}\n"
+    "Ensure every field has a value. Predict every value to the best of your ability. No field should be empty. "
+    "Return ONLY the populated JSON object."
+)
+
 # Define paths
 HOME = Path.home()
 CONTEXT_FOLDER_PATH = f'{HOME}/context'
 
+# Ollama serves quantized weights: the default gemma3:4b tag is Q4_K_M, a
+# quarter of the fp16 bytes per token. Set CAPTION_MODEL to another tag
+# (e.g. gemma3:4b-it-q8_0) to trade speed for precision.
+MODEL = os.environ.get("CAPTION_MODEL", "gemma3:4b")
+# keep the weights resident between a warm-up and the real batches
+KEEP_ALIVE = "10m"
+
 def process_video_images(video_file, caption_path):
     images_folder_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images'
 
@@ -20,7 +43,8 @@ def process_video_images(video_file, caption_path):
         return
 
     # Get list of images
-    images = [f for f in os.listdir(images_folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    with os.scandir(images_folder_path) as it:
+        images = [(e.name, e.path) for e in it if e.name.lower().endswith(('.png', '.jpg', '.jpeg'))]
     images.sort() # Ensure consistent order
 
     if not images:
@@ -29,8 +53,8 @@ def process_video_images(video_file, caption_path):
 
     # process all the images
     for i in range(0,len(images)):
-        image_file = images[i]
-        image_path = os.path.abspath(os.path.join(images_folder_path, image_file))
+        image_file, image_path = images[i]
+        image_path = os.path.abspath(image_path)
         if not os.path.exists(image_path):
             print(f"❌ Image file does not exist: {image_path}")
             return
@@ -42,16 +66,12 @@ def process_video_images(video_file, caption_path):
         
         prompt = (
             f"Context: The following is the transcription around the time this frame was taken: '{transcript}'\n\n"
-            "Analyze the provided image in detail. "
-            "Fill in the following JSON template based on the image content and the provided context:\n"
-            f"{json.dumps(schema, indent=2)}\n"
-            "Ensure every field has a value. Predict every value to the best of your ability. No field should be empty. "
-            "Return ONLY the populated JSON object."
+            + _PROMPT_SUFFIX
         )
 
         try:
             resp = ollama.chat(
-                model="gemma3:4b",
+                model=MODEL,
                 messages=[
                     {
                         "role": "user",
@@ -79,31 +99,36 @@ def process_video_images(video_file, caption_path):
         except Exception as e:
             print(f"Error calling Ollama: {e}")
 
+@lru_cache(maxsize=4)
+def _load_transcript(csv_path, mtime_ns, size):
+    """Parse the word CSV once per version into sorted (start_sec, word) arrays"""
+    df = pd.read_csv(csv_path, usecols=['start_sec', 'word'], dtype={'word': str}, keep_default_na=False)
+    df = df.sort_values('start_sec', kind='stable')
+    return df['start_sec'].to_numpy(dtype=np.float64), df['word'].to_numpy()
+
 def get_transcript(video_file, image_file):
     csv_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/audio/transcript_16k_word_ts.csv'
-    import csv
     try:
         ts = float(Path(image_file).stem)
     except ValueError:
         return "no transcription"
 
-    if not os.path.exists(csv_path):
+    try:
+        st = os.stat(csv_path)
+    except FileNotFoundError:
         return "no transcription"
 
-    with open(csv_path, 'r') as f:
-        rows = list(csv.DictReader(f))
+    # A re-run rewrites the CSV at the same path, so its mtime and size are part of the key
+    starts, words = _load_transcript(csv_path, st.st_mtime_ns, st.st_size)
 
-    words = []
     window = 5.0
-    for r in rows:
-        row_ts = float(r['start_sec'])
-        if abs(row_ts - ts) <= window:
-            words.append(r['word'])
+    lo = np.searchsorted(starts, ts - window, side='left')
+    hi = np.searchsorted(starts, ts + window, side='right')
 
-    if not words:
+    if lo == hi:
         return "no transcription"
     
-    return " ".join(words).strip()
+    return " ".join(words[lo:hi]).strip()
     
 
 def newEntry(image_file, caption_path, caption):
@@ -115,19 +140,77 @@ def newEntry(image_file, caption_path, caption):
     # Convert string response to JSON object if necessary
     if isinstance(caption, str):
         try:
-            caption_data = json.loads(caption)
-        except json.JSONDecodeError:
+            caption_data = orjson.loads(caption)
+        except orjson.JSONDecodeError:
             print("⚠️ Warning: Ollama returned invalid JSON. Saving as raw string.")
             caption_data = {"raw_content": caption}
     else:
         caption_data = caption
 
-    # Write as formatted JSON
-    with open(file_path, 'w') as f:
-        json.dump(caption_data, f, indent=4)
+    # Write as formatted JSON to a temp file, then swap it in atomically so
+    # a crash mid-write never leaves a truncated caption behind
+    with open(f'{file_path}.tmp', 'wb') as f:
+        f.write(orjson.dumps(caption_data, option=orjson.OPT_INDENT_2))
+    os.replace(f'{file_path}.tmp', file_path)
     
     print(f"✅ Caption saved to {file_path}")
 
+async def _caption_one(client, video_file, caption_path, image_path):
+    image_file = Path(image_path).name
+    transcript = get_transcript(video_file, image_file)
+    prompt = (
+        f"Context: The following is the transcription around the time this frame was taken: '{transcript}'\n\n"
+        + _PROMPT_SUFFIX
+    )
+    try:
+        resp = await client.chat(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt, "images": [str(image_path)]}],
+            format="json",
+            options={"temperature": 0.2, "num_ctx": 4096},
+            keep_alive=KEEP_ALIVE
+        )
+        await asyncio.to_thread(newEntry, image_file, caption_path, resp["message"]["content"])
+    except Exception as e:
+        print(f"Error calling Ollama for {image_file}: {e}")
+
+async def _check_gpu_offload(client):
+    """Warn when Ollama has not put the whole caption model in VRAM"""
+    try:
+        running = (await client.ps()).models
+    except Exception as e:
+        print(f"⚠️ Warning: could not query loaded models: {e}")
+        return
+    for m in running:
+        if m.model == MODEL and m.size and (m.size_vram or 0) < m.size:
+            print(f"⚠️ Warning: only {(m.size_vram or 0) / m.size:.0%} of {MODEL} is on the GPU; "
+                  "the rest runs on CPU. Free VRAM or pick a smaller CAPTION_MODEL.")
+
+async def _caption_batches(video_file, frame_paths, caption_path, batch_size):
+    async with ollama.AsyncClient() as client:
+        frames = iter(frame_paths)
+        first = True
+        # a whole batch is in flight at once so Ollama can schedule the
+        # requests together (OLLAMA_NUM_PARALLEL slots) instead of one by one
+        while batch := list(islice(frames, batch_size)):
+            await asyncio.gather(*[_caption_one(client, video_file, caption_path, p) for p in batch])
+            # the model is only resident once the first batch has loaded it
+            if first:
+                await _check_gpu_offload(client)
+                first = False
+
+def warmup():
+    """Have Ollama load the caption model now, so the first batch does not pay for it"""
+    try:
+        # an empty prompt only loads the model
+        ollama.generate(model=MODEL, prompt="", keep_alive=KEEP_ALIVE)
+    except Exception as e:
+        print(f"⚠️ Caption model warm-up failed: {e}")
+
+def execute_batch(video_file, frame_paths, caption_path, batch_size=16):
+    """Caption the given frames batch_size requests at a time"""
+    asyncio.run(_caption_batches(video_file, frame_paths, caption_path, batch_size))
+
 def execute(video_file):
     caption_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/images_caption'
     return process_video_images(video_file, caption_path)
@@ -1,11 +1,26 @@
 import ollama
-import json
+import orjson
+import asyncio
 import os
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
+import pandas as pd
 
 # Load schema
-with open("image_caption_schema.json", "r") as f:
-    schema = json.load(f)
+with open("image_caption_schema.json", "rb") as f:
+    schema = orjson.loads(f.read())
+
+# The schema never changes, so serialize it into the prompt template once.
+# It is appended rather than .format()-ed because the schema is full of braces
+_SCHEMA_JSON = orjson.dumps(schema, option=orjson.OPT_INDENT_2).decode()
+_PROMPT_SUFFIX = (
+    "Analyze the provided image in detail. "
+    "Fill in the following JSON template based on the image content and the provided context:\n"
+    f"{_SCHEMA_JSON}\n"
+    "Ensure every field has a value. Predict every value to the best of your ability. No field should be empty. "
+    "Return ONLY the populated JSON object."
+)
 
 # Define paths
 HOME = Path.home()
@@ -20,40 +35,46 @@ def process_video_images(video_file, caption_path):
         return
 
     # Get list of images
-    images = [f for f in os.listdir(images_folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    with os.scandir(images_folder_path) as it:
+        images = [(e.name, e.path) for e in it if e.name.lower().endswith(('.png', '.jpg', '.jpeg'))]
     images.sort() # Ensure consistent order
 
     if not images:
         print("No images found in the folder.")
         return
 
-    # process all the images
-    for i in range(3,4):
-        image_file = images[i]
-        image_path = os.path.abspath(os.path.join(images_folder_path, image_file))
-        if not os.path.exists(image_path):
-            print(f"❌ Image file does not exist: {image_path}")
-            return
-        print(f"Processing image: {image_path}")
-
-        # get the transcription of the current scene
-        transcript = get_transcript(video_file, image_file)
-        print("transcript : ", transcript)
-        
-        prompt = (
-            f"Context: The following is the transcription around the time this frame was taken: '{transcript}'\n\n"
-            "Analyze the provided image in detail. "
-            "Fill in the following JSON template based on the image content and the provided context:\n"
-            f"{json.dumps(schema, indent=2)}\n"
-            "Ensure every field has a value. Predict every value to the best of your ability. No field should be empty. "
-            "Return ONLY the populated JSON object."
-        )
-
-        print("\n=== Prompt ===")
-        print(prompt)
+    # process the test slice of images, several requests in flight at once
+    asyncio.run(caption_images(video_file, caption_path, images[3:4]))
 
-        try:
-            resp = ollama.chat(
+async def caption_images(video_file, caption_path, images, max_concurrent=4):
+    """Dispatch one chat per image over a shared AsyncClient, bounded by a semaphore"""
+    semaphore = asyncio.Semaphore(max_concurrent)
+    async with ollama.AsyncClient() as client:
+        await asyncio.gather(*[caption_one(client, semaphore, video_file, caption_path, image_file, image_path)
+                               for image_file, image_path in images])
+
+async def caption_one(client, semaphore, video_file, caption_path, image_file, image_path):
+    image_path = os.path.abspath(image_path)
+    if not os.path.exists(image_path):
+        print(f"❌ Image file does not exist: {image_path}")
+        return
+    print(f"Processing image: {image_path}")
+
+    # get the transcription of the current scene
+    transcript = get_transcript(video_file, image_file)
+    print("transcript : ", transcript)
+    
+    prompt = (
+        f"Context: The following is the transcription around the time this frame was taken: '{transcript}'\n\n"
+        + _PROMPT_SUFFIX
+    )
+
+    print("\n=== Prompt ===")
+    print(prompt)
+
+    try:
+        async with semaphore:
+            resp = await client.chat(
                 model="gemma3:4b",
                 messages=[
                     {
@@ -69,44 +90,49 @@ def process_video_images(video_file, caption_path):
                 }
             )
 
-            content = resp["message"]["content"]
-            print("\n=== Answer ===")
-            print(content)
-            
-            if content.strip() == "{}":
-                print("⚠️ Warning: Ollama returned an empty JSON object. Check model/image.")
-            
-            # Save the result
-            newEntry(image_file, caption_path, content)
+        content = resp["message"]["content"]
+        print("\n=== Answer ===")
+        print(content)
+        
+        if content.strip() == "{}":
+            print("⚠️ Warning: Ollama returned an empty JSON object. Check model/image.")
+        
+        # Save the result off the event loop
+        await asyncio.to_thread(newEntry, image_file, caption_path, content)
+
+    except Exception as e:
+        print(f"Error calling Ollama: {e}")
 
-        except Exception as e:
-            print(f"Error calling Ollama: {e}")
+@lru_cache(maxsize=4)
+def _load_transcript(csv_path, mtime_ns, size):
+    """Parse the word CSV once per version into sorted (start_sec, word) arrays"""
+    df = pd.read_csv(csv_path, usecols=['start_sec', 'word'], dtype={'word': str}, keep_default_na=False)
+    df = df.sort_values('start_sec', kind='stable')
+    return df['start_sec'].to_numpy(dtype=np.float64), df['word'].to_numpy()
 
 def get_transcript(video_file, image_file):
     csv_path = f'{CONTEXT_FOLDER_PATH}/{video_file}/audio/transcript_16k_word_ts.csv'
-    import csv
     try:
         ts = float(Path(image_file).stem)
     except ValueError:
         return "no transcription"
 
-    if not os.path.exists(csv_path):
+    try:
+        st = os.stat(csv_path)
+    except FileNotFoundError:
         return "no transcription"
 
-    with open(csv_path, 'r') as f:
-        rows = list(csv.DictReader(f))
+    # A re-run rewrites the CSV at the same path, so its mtime and size are part of the key
+    starts, words = _load_transcript(csv_path, st.st_mtime_ns, st.st_size)
 
-    words = []
     window = 5.0
-    for r in rows:
-        row_ts = float(r['start_sec'])
-        if abs(row_ts - ts) <= window:
-            words.append(r['word'])
+    lo = np.searchsorted(starts, ts - window, side='left')
+    hi = np.searchsorted(starts, ts + window, side='right')
 
-    if not words:
+    if lo == hi:
         return "no transcription"
     
-    return " ".join(words).strip()
+    return " ".join(words[lo:hi]).strip()
     
 
 def newEntry(image_file, caption_path, caption):
@@ -118,16 +144,18 @@ def newEntry(image_file, caption_path, caption):
     # Convert string response to JSON object if necessary
     if isinstance(caption, str):
         try:
-            caption_data = json.loads(caption)
-        except json.JSONDecodeError:
+            caption_data = orjson.loads(caption)
+        except orjson.JSONDecodeError:
             print("⚠️ Warning: Ollama returned invalid JSON. Saving as raw string.")
             caption_data = {"raw_content": caption}
     else:
         caption_data = caption
 
-    # Write as formatted JSON
-    with open(file_path, 'w') as f:
-        json.dump(caption_data, f, indent=4)
+    # Write as formatted JSON to a temp file, then swap it in atomically so
+    # a crash mid-write never leaves a truncated caption behind
+    with open(f'{file_path}.tmp', 'wb') as f:
+        f.write(orjson.dumps(caption_data, option=orjson.OPT_INDENT_2))
+    os.replace(f'{file_path}.tmp', file_path)
     
     print(f"✅ Caption saved to {file_path}")
 
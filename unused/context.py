@@ -1,43 +1,189 @@
-from time import time
-import shutil
+from time import perf_counter
+import asyncio
+import hashlib
+import orjson
+import queue
 import frameExtractor as fe 
 import transcription as tr
 import caption_images as ci
+import caption_images_enhanced as cie
 import os
 from pathlib import Path
 
 keyframes_folder_path = fe.frames_folder_path
 
-def get_frames():
-    # extract keyframes
-    fe.execute()
+def get_frames(video_path, frame_queue=None):
+    # extract keyframes only (the decoder skips every P/B frame), publishing
+    # each image name as soon as it is on disk
+    fe.execute(str(video_path), frame_queue=frame_queue, keyframes_only=True)
 
 def get_transcript(video_path):
-    # check if the folder exists, if so delete it
-    if os.path.exists('audio'):
-        shutil.rmtree('audio')
+    # clear any old audio folder without blocking on the delete
+    tr.discard_folder('audio')
 
     # transcribe audio
     tr.execute(video_path)    
 
 def caption_images(video_file, caption_path):
-    ci.execute(video_file, caption_path)
+    ci.process_video_images(video_file, caption_path)
 
-if __name__ == "__main__":
-    video_file = "demo.mp4"
-    video_path = Path.home()/ "Downloads" / "demo.mp4"
-    t0 = time()
-    get_frames()
-    get_transcript(video_path)
-    t1 = time()
-    print(t1 - t0)
+def frame_hash(frame_path):
+    """Short content hash of a frame file"""
+    with open(frame_path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+def load_caption_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+def save_caption_cache(cache_path, cache):
+    with open(f'{cache_path}.tmp', 'wb') as f:
+        f.write(orjson.dumps(cache))
+    os.replace(f'{cache_path}.tmp', cache_path)
+
+def read_caption(caption_path, image_file):
+    """A frame's saved caption, or None if it is missing, unparseable or an unparsed reply"""
+    try:
+        with open(f'{caption_path}/{image_file}.json', 'rb') as f:
+            caption = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return None
+    if type(caption) is not dict or "raw_content" in caption:
+        return None
+    return caption
+
+def remember_captions(caption_path, cache, captioned):
+    """Add the usable captions of {hash: frame_path} to the cache"""
+    for h, p in captioned.items():
+        caption = read_caption(caption_path, p.name)
+        if caption is not None:
+            cache[h] = caption
+
+def caption_images_batched(video_file, caption_path, batch_size=16, duplicates=None, frame_paths=None):
+    duplicates = duplicates or {}
+    if frame_paths is None:
+        images_folder = Path.home()/"context"/video_file/"images"
+        frame_paths = sorted(images_folder.glob("*.jpg"), key=lambda p: float(p.stem))
+
+    # captions are keyed by frame content, so frames seen on an earlier run
+    # (or repeated within this one) never go back through the model
+    # kept beside the caption folder, not in it: everything in there is read as a caption
+    cache_path = Path(caption_path).parent/"caption_cache.json"
+    cache = load_caption_cache(cache_path)
+    hashes = {p: frame_hash(p) for p in frame_paths}
+    pending = {}
+    for p, h in hashes.items():
+        # near-duplicates borrow their representative's caption below
+        if h not in cache and p.name not in duplicates:
+            pending.setdefault(h, p)
+
+    # every new frame goes through the captioner batch_size at a time
+    ci.execute_batch(video_file, list(pending.values()), caption_path, batch_size=batch_size)
+    remember_captions(caption_path, cache, pending)
+
+    def fill_from_cache():
+        for p, h in hashes.items():
+            if h in cache and not os.path.exists(f'{caption_path}/{p.name}.json'):
+                ci.newEntry(p.name, caption_path, cache[h])
+    fill_from_cache()
+
+    # a duplicate whose representative has no usable caption is captioned itself
+    by_name = {p.name: p for p in frame_paths}
+    uncaptioned = {}
+    for image_file, ref in duplicates.items():
+        if os.path.exists(f'{caption_path}/{image_file}.json'):
+            continue
+        caption = read_caption(caption_path, ref)
+        if caption is None:
+            uncaptioned.setdefault(hashes[by_name[image_file]], by_name[image_file])
+        else:
+            ci.newEntry(image_file, caption_path, caption)
+    if uncaptioned:
+        print(f"🔁 Captioning {len(uncaptioned)} frames whose representative has no caption")
+        ci.execute_batch(video_file, list(uncaptioned.values()), caption_path, batch_size=batch_size)
+        remember_captions(caption_path, cache, uncaptioned)
+        fill_from_cache()
+    save_caption_cache(cache_path, cache)
+
+def caption_frames_from_queue(video_file, caption_path, frame_queue, batch_size=16):
+    """Caption frames as extraction publishes them, until the None sentinel arrives"""
+    images_folder = Path.home()/"context"/video_file/"images"
+    previous = None
+    done = False
+    while not done:
+        # wait for the first frame of a batch, then take whatever else turns up quickly
+        batch = []
+        timeout = None
+        while len(batch) < batch_size:
+            try:
+                image_file = frame_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if image_file is None:
+                done = True
+                break
+            batch.append(images_folder/image_file)
+            timeout = 0.5
+        if not batch:
+            continue
+        batch.sort(key=lambda p: float(p.stem))
+
+        # frames of a static shot are captioned once and the caption shared; the
+        # last frame of the previous batch lets a shot carry across batches
+        scope = ([previous] if previous else []) + batch
+        duplicates = cie.find_duplicate_frames([(p.name, p) for p in scope])
+        caption_images_batched(video_file, caption_path, batch_size, duplicates, frame_paths=batch)
+        previous = batch[-1]
+
+def timed(timings, stage, fn, *args, **kwargs):
+    """Run fn and record its wall time in seconds under timings[stage]"""
+    start = perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round(perf_counter() - start, 3)
+
+async def main(video_file, video_path):
+    timings = {}
+    t0 = perf_counter()
     # make a folder for the image caption
-    caption_path = Path.home()/"context"/f"video_file"/"images_caption"
-    if not os.path.exists(caption_path):
-        os.makedirs(caption_path)
-    caption_images(video_file, caption_path)
-    
-        
+    caption_path = Path.home()/"context"/video_file/"images_caption"
+    caption_path.mkdir(parents=True, exist_ok=True)
+
+    frame_queue = queue.Queue()
 
+    async def caption():
+        # captions need the transcript around each frame, so frames queue up
+        # until it is done; the caption model loads in the meantime
+        await asyncio.gather(
+            asyncio.to_thread(timed, timings, "transcript", get_transcript, video_path),
+            asyncio.to_thread(timed, timings, "caption_warmup", ci.warmup),
+        )
+        await asyncio.to_thread(timed, timings, "captions", caption_frames_from_queue,
+                                video_file, caption_path, frame_queue)
 
+    # frames and audio come from independent inputs, so extract them side by
+    # side; captioning drains the frame queue while extraction is still running
+    await asyncio.gather(
+        asyncio.to_thread(timed, timings, "frames", get_frames, video_path, frame_queue),
+        caption(),
+    )
+    timings["total"] = round(perf_counter() - t0, 3)
+    # stages overlap, so they add up to more than the total
+    print(orjson.dumps(timings).decode())
+    return timings
 
+if __name__ == "__main__":
+    video_file = "demo.mp4"
+    video_path = Path.home()/ "Downloads" / "demo.mp4"
+    import worker
+    try:
+        # a running worker (python worker.py) already has everything loaded
+        result = worker.submit(video_file, video_path)
+        if not result["ok"]:
+            print(f"❌ Worker failed: {result['error']}")
+    except ConnectionRefusedError:
+        asyncio.run(main(video_file, video_path))
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import secrets
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+import context
+
+# The worker keeps frameExtractor, transcription and caption_images (and
+# whatever models they hold) imported between jobs; clients only send paths
+ADDRESS = ("127.0.0.1", int(os.environ.get("CONTEXT_WORKER_PORT", "6001")))
+AUTHKEY_PATH = Path.home()/"context"/".worker_authkey"
+
+def load_authkey():
+    """CONTEXT_WORKER_AUTHKEY, or a random key kept in a file only this user can read"""
+    if key := os.environ.get("CONTEXT_WORKER_AUTHKEY"):
+        return key.encode()
+    # recv() unpickles, so the key must never be guessable
+    AUTHKEY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        fd = os.open(AUTHKEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return AUTHKEY_PATH.read_bytes()
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def serve():
+    """Run jobs one at a time for as long as the process lives"""
+    context.ci.warmup()
+    with Listener(ADDRESS, authkey=load_authkey()) as listener:
+        print(f"🚀 Worker listening on {ADDRESS[0]}:{ADDRESS[1]}")
+        while True:
+            # a client that fails the handshake or hangs up only loses its own job
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError) as e:
+                print(f"⚠️ Rejected connection: {e}")
+                continue
+            with conn:
+                try:
+                    job = conn.recv()
+                except (EOFError, OSError) as e:
+                    print(f"⚠️ Client went away before sending a job: {e}")
+                    continue
+                try:
+                    print(f"Processing {job['video_path']}")
+                    asyncio.run(context.main(job["video_file"], job["video_path"]))
+                    result = {"ok": True}
+                except Exception as e:
+                    print(f"❌ Job failed: {e}")
+                    result = {"ok": False, "error": str(e)}
+                try:
+                    conn.send(result)
+                except OSError as e:
+                    print(f"⚠️ Could not report the result: {e}")
+
+def submit(video_file, video_path):
+    """Hand one video to a running worker and wait for it to finish"""
+    with Client(ADDRESS, authkey=load_authkey()) as conn:
+        conn.send({"video_file": video_file, "video_path": str(video_path)})
+        return conn.recv()
+
+if __name__ == "__main__":
+    serve()